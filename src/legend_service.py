@@ -1,15 +1,28 @@
-import base64
+import binascii
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
 from io import BytesIO
 import os
+import stat
 import tempfile
-import uuid
+from threading import Lock
 
-from PIL import Image
-from flask import Response, send_file
+from PIL import Image, UnidentifiedImageError
+from flask import Response, request, send_file
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # optional libvips bindings for composing legend images
+    import pyvips
+except ImportError:
+    pyvips = None
 
 from qwc_services_core.permissions_reader import PermissionsReader
 from qwc_services_core.runtime_config import RuntimeConfig
+from ttl_cache import TTLCache
 
 
 PIL_Formats = {
@@ -24,11 +37,90 @@ PIL_Formats = {
     "image/webp": "WebP"
 }
 
+# fast encoder settings for PIL formats
+# NOTE: legend images are small and mostly flat, so high compression levels
+#       waste CPU for little size reduction
+PIL_SAVE_OPTIONS = {
+    "PNG": {"compress_level": 1, "optimize": False},
+    "JPEG": {"quality": 85, "optimize": False, "progressive": False},
+    # NOTE: lossless to keep legend text and symbols crisp
+    "WebP": {"lossless": True, "method": 4}
+}
+
+# PIL resampling filters for scaling legend images
+RESAMPLE_FILTERS = {
+    "LANCZOS": Image.Resampling.LANCZOS,
+    "BICUBIC": Image.Resampling.BICUBIC,
+    "BILINEAR": Image.Resampling.BILINEAR
+}
+
+# max number of pixels of composed legends for joining raw pixel rows
+# NOTE: joining keeps the raw pixels of all images in memory at once,
+#       so larger legends are composed by pasting images one at a time
+IMAGE_JOIN_PIXELS_MAX = 1024 * 1024
+
+# cache for loaded service resources shared by service instances as
+#     {(<tenant>, <config mtime>, <legend images path>,
+#       <Base64 images path>): <resources>}
+# NOTE: resources are shared and must not be modified
+RESOURCES_CACHE = TTLCache(maxsize=64, ttl=None)
+
+# marker for values not found in caches
+MISSING = object()
+
+# default base dir for extracted Base64 encoded legend images
+# NOTE: files are named by the hash of their content and kept across
+#       reloads, so unchanged images are not extracted again
+BASE64_IMAGES_PATH = '/var/cache/qwc-legend-service'
+
+# private temporary fallback dir for Base64 encoded legend images,
+# if base64_images_path is not usable
+# NOTE: created on demand and removed on exit
+BASE64_FALLBACK_DIR = None
+BASE64_FALLBACK_LOCK = Lock()
+
+# time in seconds to cache custom legend image lookups
+LEGEND_IMAGES_CACHE_TTL = 60
+
+# libvips save options for formats supported when composing with pyvips
+VIPS_SAVE_FORMATS = {
+    "image/png": ".png[compression=1]",
+    "image/jpeg": ".jpg[Q=85]",
+    "image/webp": ".webp[lossless]"
+}
+
 FORMATS_WITH_ALPHA = set([
     "image/png",
     "image/webp"
 ])
 
+# file signatures for detecting image formats
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', "image/png"),
+    (b'\xff\xd8\xff', "image/jpeg"),
+    (b'GIF87a', "image/gif"),
+    (b'GIF89a', "image/gif"),
+    (b'II*\x00', "image/tiff"),
+    (b'MM\x00*', "image/tiff")
+]
+
+# valid BMP DIB header sizes
+# NOTE: 'BM' alone is too weak as signature for detecting BMP images
+BMP_DIB_HEADER_SIZES = frozenset([12, 40, 52, 56, 64, 108, 124])
+
+
+@lru_cache(maxsize=16)
+def empty_image(pil_format):
+    """Return encoded empty 1x1 white image.
+
+    :param str pil_format: PIL image format
+    """
+    output = BytesIO()
+    Image.new("RGB", (1, 1), (255, 255, 255)).save(
+        output, pil_format, **PIL_SAVE_OPTIONS.get(pil_format, {})
+    )
+    return output.getvalue()
+
 
 class LegendService:
     """LegendService class
@@ -45,6 +137,16 @@ class LegendService:
         self.tenant = tenant
         self.logger = logger
 
+        # NOTE: get config file mtime before reading the config, so that
+        #       any later changes are not cached for this mtime
+        config_mtime = None
+        try:
+            config_mtime = os.stat(
+                RuntimeConfig.config_file_path("legend", tenant)
+            ).st_mtime_ns
+        except OSError:
+            pass
+
         config_handler = RuntimeConfig("legend", logger)
         config = config_handler.tenant_config(tenant)
 
@@ -55,18 +157,142 @@ class LegendService:
         self.basic_auth_login_url = config.get('basic_auth_login_url')
         self.legend_default_font_size = config.get("legend_default_font_size")
 
+        # get resampling filter for scaling legend images to requested DPI
+        resample_filter = config.get('resample_filter', 'LANCZOS')
+        if resample_filter not in RESAMPLE_FILTERS:
+            self.logger.warning(
+                "Unsupported resample_filter '%s', falling back to LANCZOS"
+                % resample_filter
+            )
+            resample_filter = 'LANCZOS'
+        self.resample_filter = RESAMPLE_FILTERS[resample_filter]
+
+        # cache for file names in legend image dirs as {<dir>: <file names>}
+        # NOTE: dirs are rescanned after expiry to detect new files
+        self.legend_dirs_cache = TTLCache(
+            maxsize=256, ttl=LEGEND_IMAGES_CACHE_TTL
+        )
+
+        # cache for custom legend image lookups as
+        #     {(<service>, <layer>, <type>): (<path>, <data>) or None}
+        self.legend_images_cache = TTLCache(
+            maxsize=4096, ttl=LEGEND_IMAGES_CACHE_TTL
+        )
+
+        # cache for legend image files as {(<path>, <mtime>): <data>}
+        self.legend_files_cache = TTLCache(maxsize=256, ttl=None)
+
+        # cache for custom legend images scaled to requested DPI as
+        #     {(<original data>, <dpi>): <PNG data>}
+        # NOTE: original image data as key, so modified files are rescaled
+        self.scaled_images_cache = TTLCache(maxsize=256, ttl=None)
+
+        # cache for permitted resources as
+        #     {(<service>, <roles>): <permitted resources or None>}
+        # NOTE: permissions are reloaded together with this service instance
+        self.permitted_resources_cache = TTLCache(maxsize=1024, ttl=None)
+
+        # cache for expanded layers as
+        #     {(<service>, <permitted layers>, <layers>, <styles>): <layer styles>}
+        self.expanded_layers_cache = TTLCache(maxsize=1024, ttl=None)
+
+        # lookup for pending QGIS server requests as {<key>: <Future>}
+        self.legend_fetches = {}
+        self.legend_fetches_lock = Lock()
+
+        # cache for legend images from QGIS server
+        self.legend_cache = TTLCache(
+            maxsize=512, ttl=config.get('legend_cache_ttl', 300)
+        )
+
+        # cache for composed legends as
+        #     {(<service>, <permitted layers>, <request params>):
+        #      (<data>, <ETag>)}
+        # NOTE: expires together with custom legend image lookups
+        self.responses_cache = TTLCache(
+            maxsize=512, ttl=min(
+                config.get('legend_cache_ttl', 300), LEGEND_IMAGES_CACHE_TTL
+            )
+        )
+
+        # return WebP instead of requested PNG if accepted by client
+        self.webp_negotiation = config.get('webp_negotiation', False)
+
+        # max age in seconds for clients to cache legend images
+        # without revalidation
+        self.cache_max_age = config.get('cache_max_age', 0)
+
         # get path to legend images from config
         self.legend_images_path = config.get('legend_images_path', '/legends/')
 
-        # temporary target dir for any Base64 encoded legend images
-        # NOTE: this dir will be cleaned up automatically on reload
-        self.images_temp_dir = None
+        # base dir for extracted Base64 encoded legend images
+        self.base64_images_path = config.get(
+            'base64_images_path', BASE64_IMAGES_PATH
+        )
+        # private dir for Base64 encoded legend images of tenant,
+        # created on demand
+        self.base64_images_dir = MISSING
+
+        # fallback default legend image files as
+        #     {<type>: (<absolute paths>, <allowempty>)}
+        self.default_candidate_files = self.candidate_files(
+            self.legend_images_path, 'default'
+        )
 
-        self.resources = self.load_resources(config)
+        # NOTE: reuse resources for unchanged config, e.g. if service is
+        #       reloaded for changed permissions
+        cache_key = (
+            tenant, config_mtime, self.legend_images_path,
+            self.base64_images_path
+        )
+        self.resources = None
+        if config_mtime is not None:
+            self.resources = RESOURCES_CACHE.get(cache_key)
+        if self.resources is None:
+            self.resources = self.load_resources(config)
+            if config_mtime is not None:
+                RESOURCES_CACHE.set(cache_key, self.resources)
         self.permissions_handler = PermissionsReader(tenant, logger)
 
+        # thread pool for fetching legend images of multiple layers
+        # NOTE: worker threads are reused across requests and exit once
+        #       this service instance is discarded on reload
+        self.executor = ThreadPoolExecutor(
+            max_workers=8, thread_name_prefix='legend-service'
+        )
+
+        # HTTP session with connection pool for QGIS server requests
+        # NOTE: reuses keep-alive connections across requests and layers
+        # NOTE: keep enough connections for the fetch thread pool and
+        #       concurrent single layer requests, as surplus connections
+        #       are closed after use
+        # NOTE: only retry failed connections, as retrying read timeouts
+        #       or error responses of a hung QGIS server would only
+        #       block the worker for longer
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10, pool_maxsize=64,
+            max_retries=Retry(
+                total=2, connect=2, read=False, status=0, backoff_factor=0.1
+            )
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # resolve proxy and CA bundle settings from environment once,
+        # instead of on every request
+        # NOTE: this also skips the .netrc lookup per request
+        self.session.trust_env = False
+        self.session.proxies = requests.utils.get_environ_proxies(
+            self.qgis_server_url
+        )
+        self.session.verify = (
+            os.environ.get('REQUESTS_CA_BUNDLE') or
+            os.environ.get('CURL_CA_BUNDLE') or
+            True
+        )
+
     def get_legend(self, service_name, layer_param, styles_param, format_param, params, type,
-                   identity):
+                   identity, webp_accepted=False):
         """Return legend graphic for specified layer.
 
         :param str service_name: Service name
@@ -76,8 +302,10 @@ class LegendService:
         :param dict params: Other params to forward to QGIS Server
         :param str type: The legend image type, either "default", "thumbnail" or "tooltip".
         :param obj identity: User identity
+        :param bool webp_accepted: Whether client accepts WebP images
         """
-        if not self.wms_permitted(service_name, identity):
+        permitted_resources = self.permitted_resources(service_name, identity)
+        if permitted_resources is None:
             # map unknown or not permitted
             return self.service_exception(
                 'MapNotDefined',
@@ -90,92 +318,42 @@ class LegendService:
             )
             format_param = "image/png"
 
-        # get permitted resources
-        requested_layers = layer_param.split(',')
-        requested_layer_styles = self.padded_styles(requested_layers, styles_param)
-        permitted_resources = self.permitted_resources(service_name, identity)
-        permitted_layers = permitted_resources['permitted_layers']
-        public_layers = permitted_resources['public_layers']
-        group_layers = permitted_resources['groups_to_expand']
-        # filter layers by permissions
-        requested_layer_styles = [
-            entry for entry in requested_layer_styles
-            if entry['layer'] in public_layers
-        ]
-        # replace group layers containing custom legends with permitted
-        # sublayers
-        expanded_layer_styles = self.expand_group_layers(
-            requested_layer_styles, group_layers, permitted_layers
+        # image format for requesting legend images from the QGIS server
+        request_format = format_param
+        if (
+            format_param == "image/png" and webp_accepted and
+            self.webp_negotiation
+        ):
+            # return WebP instead of PNG if accepted by client
+            format_param = "image/webp"
+
+        pil_format = PIL_Formats[format_param]
+        save_options = PIL_SAVE_OPTIONS.get(pil_format, {})
+
+        # check for cached legend
+        # NOTE: legends only depend on the permitted layers of the identity
+        cache_key = (
+            service_name, permitted_resources['permitted_layers'],
+            layer_param, styles_param, format_param,
+            tuple(sorted(params.items())), type
         )
+        cached = self.responses_cache.get(cache_key)
+        if cached is not None:
+            data, etag = cached
+            return self.image_response(data, format_param, etag)
 
-        self.logger.debug("Requested layers: %s" % requested_layers)
-        self.logger.debug("Expanded layers:  %s" % expanded_layer_styles)
+        expanded_layer_styles = self.expanded_layer_styles(
+            service_name, layer_param, styles_param, permitted_resources
+        )
 
-        dpi = params.get('dpi')
-        imgdata = []
-        for layer_style in expanded_layer_styles:
-            legend_image = self.get_legend_image(service_name, layer_style['layer'], type)
-            if legend_image is not None:
-                if dpi and dpi != '90':
-                    try:
-                        # scale image to requested DPI
-                        img = Image.open(BytesIO(legend_image))
-                        scale = float(dpi) / 90.0
-                        new_size = (
-                            int(img.width * scale), int(img.height * scale)
-                        )
-                        img = img.resize(new_size, Image.ANTIALIAS)
-                        output = BytesIO()
-                        # NOTE: save as PNG to preserve any alpha channel
-                        img.save(output, "PNG")
-                        imgdata.append({"data": output, "format": None})
-                    except Exception as e:
-                        self.logger.error(
-                            "Could not resize image for %s:\n%s" % (layer_style['layer'], e)
-                        )
-                        imgdata.append(
-                            {"data": BytesIO(legend_image), "format": None}
-                        )
-                else:
-                    imgdata.append({
-                        "data": BytesIO(legend_image), "format": None
-                    })
-            else:
-                req_params = {
-                    "service": "WMS",
-                    "version": "1.3.0",
-                    "request": "GetLegendGraphic",
-                    "layer": layer_style['layer'],
-                    "format": format_param,
-                    "style": layer_style['style']
-                }
-                req_params.update(params)
-                if self.legend_default_font_size:
-                    if 'layerfontsize' not in req_params:
-                        req_params['layerfontsize'] = \
-                            self.legend_default_font_size
-                    if 'itemfontsize' not in req_params:
-                        req_params['itemfontsize'] = \
-                            self.legend_default_font_size
-                response = requests.get(
-                    self.qgis_server_url + service_name, params=req_params,
-                    timeout=30
-                )
-                self.logger.debug("Forwarding request to %s" % response.url)
-
-                if response.content.startswith(b'<ServiceExceptionReport'):
-                    self.logger.warning(response.content)
-                elif response.status_code == 200:
-                    buf = BytesIO()
-                    buf.write(response.content)
-                    imgdata.append({"data": buf, "format": format_param})
-                else:
-                    # Empty image in case of server error
-                    output = BytesIO()
-                    Image.new("RGB", (1, 1), (255, 255, 255)).save(
-                        output, PIL_Formats[format_param]
-                    )
-                    imgdata.append({"data": output, "format": format_param})
+        results = self.layer_legend_images(
+            service_name, expanded_layer_styles, request_format, params, type
+        )
+        imgdata = [entry for entry in results if entry is not None]
+
+        if any(entry.get("fallback") for entry in imgdata):
+            # do not cache legend with fallback images after server errors
+            cache_key = None
 
         if len(imgdata) == 0:
             # layer not found or faulty
@@ -186,58 +364,502 @@ class LegendService:
 
         # If just one image, return it
         elif len(imgdata) == 1:
+            if imgdata[0]["format"] == format_param and imgdata[0].get("path"):
+                try:
+                    # send unmodified custom legend image file
+                    # NOTE: supports conditional requests and sendfile,
+                    #       relative paths would be resolved against the
+                    #       Flask app root instead of the working directory
+                    response = send_file(
+                        os.path.abspath(imgdata[0]["path"]),
+                        mimetype=format_param,
+                        conditional=True
+                    )
+                    self.set_cache_control(response)
+                    return response
+                except OSError as e:
+                    self.logger.warning(
+                        "Could not send legend image '%s': %s",
+                        imgdata[0]["path"], e
+                    )
+
             # Convert to requested format if necessary
             if imgdata[0]["format"] != format_param:
                 output = BytesIO()
                 try:
-                    imgdata[0]["data"].seek(0)
-                    image = Image.open(imgdata[0]["data"])
+                    image = Image.open(BytesIO(imgdata[0]["data"]))
                     if not self.format_has_alpha(format_param):
                         image = self.convert_img_to_rgb(image)
-                    image.save(output, PIL_Formats[format_param])
+                    image.save(
+                        output, pil_format, **save_options
+                    )
+                    imgdata[0]["data"] = output.getvalue()
                 except Exception as e:
                     self.logger.error(
                         "Could not convert image to %s:\n%s"
                         % (format_param, e)
                     )
                     # Empty 1x1 image
-                    Image.new("RGB", (1, 1), (255, 255, 255)).save(
-                        output, PIL_Formats[format_param]
-                    )
-                output.seek(0)
-                imgdata[0]["data"] = output
+                    imgdata[0]["data"] = empty_image(pil_format)
 
-            imgdata[0]["data"].seek(0)
-            return send_file(imgdata[0]["data"], mimetype=format_param)
+            # NOTE: return bytes directly instead of wrapping them in a file
+            return self.legend_response(
+                cache_key, imgdata[0]["data"], format_param
+            )
 
         # Otherwise, compose images
+        # NOTE: only read image headers for planning the canvas,
+        #       each image is decoded when pasting it and released afterwards
         width = 0
         height = 0
+        has_alpha = False
         for entry in imgdata:
             try:
-                entry["image"] = Image.open(entry["data"])
-                if not self.format_has_alpha(format_param):
-                    entry["image"] = self.convert_img_to_rgb(entry["image"])
-                width = max(width, entry["image"].width)
-                height += entry["image"].height
-            except:
-                entry["image"] = None
-
-        if self.format_has_alpha(format_param):
-            image = Image.new("RGBA", (width, height), (255, 255, 255, 255))
-        else:
-            image = Image.new("RGB", (width, height), (255, 255, 255))
+                # NOTE: keep opened image for composing with PIL
+                img = Image.open(BytesIO(entry["data"]))
+                entry["image"] = img
+                entry["size"] = img.size
+                has_alpha |= self.image_has_alpha(img)
+                width = max(width, entry["size"][0])
+                height += entry["size"][1]
+            except (UnidentifiedImageError, OSError, ValueError) as e:
+                self.logger.warning("Could not read legend image: %s", e)
+                entry["size"] = None
+
+        images = [entry for entry in imgdata if entry["size"]]
+        if len(images) == 1 and images[0]["format"] == format_param:
+            # return only readable image if already in requested format
+            return self.legend_response(
+                cache_key, images[0]["data"], format_param
+            )
+
+        # NOTE: use RGBA canvas only if any image has an alpha channel,
+        #       to avoid mode conversions when pasting RGB or palette images
+        has_alpha = self.format_has_alpha(format_param) and has_alpha
+
+        if (
+            pyvips is not None and format_param in VIPS_SAVE_FORMATS and
+            width > 0
+        ):
+            try:
+                data = self.compose_images_vips(
+                    imgdata, width, has_alpha, format_param
+                )
+                return self.legend_response(cache_key, data, format_param)
+            except pyvips.Error as e:
+                self.logger.warning(
+                    "Could not compose images with pyvips, "
+                    "falling back to PIL:\n%s" % e
+                )
+
+        image = self.compose_images_pil(
+            imgdata, width, height, "RGBA" if has_alpha else "RGB"
+        )
+
+        output = BytesIO()
+        image.save(output, pil_format, **save_options)
+        return self.legend_response(
+            cache_key, output.getvalue(), format_param
+        )
+
+    def legend_response(self, cache_key, data, mimetype):
+        """Cache legend image and return its response.
+
+        :param tuple cache_key: Key for legend cache, or None to skip caching
+        :param bytes data: Image data
+        :param str mimetype: Image format
+        """
+        etag = self.image_etag(data)
+        if cache_key is not None:
+            # NOTE: cache ETag together with data, to avoid hashing on hits
+            self.responses_cache.set(cache_key, (data, etag))
+
+        return self.image_response(data, mimetype, etag)
+
+    def image_response(self, data, mimetype, etag=None):
+        """Return response for legend image with ETag, or 304 response if
+        it matches the conditional request.
+
+        :param bytes data: Image data
+        :param str mimetype: Image format
+        :param str etag: Optional precomputed ETag of image data
+        """
+        response = Response(data, mimetype=mimetype)
+        response.set_etag(etag or self.image_etag(data))
+        self.set_cache_control(response)
+        return response.make_conditional(request)
+
+    def image_etag(self, data):
+        """Return ETag for image data.
+
+        :param bytes data: Image data
+        """
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def set_cache_control(self, response):
+        """Allow clients to cache legend image response.
 
+        NOTE: responses depend on the user permissions, so they must not be
+              stored in shared caches
+
+        :param Response response: Legend image response
+        """
+        response.cache_control.private = True
+        if self.cache_max_age > 0:
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = self.cache_max_age
+        else:
+            # always revalidate
+            response.cache_control.no_cache = True
+        if self.webp_negotiation:
+            # response format may depend on Accept header
+            response.vary.add('Accept')
+
+    def compose_images_pil(self, imgdata, width, height, mode):
+        """Compose legend images vertically using PIL and return the
+        composed image.
+
+        :param list(obj) imgdata: Image entries with opened image and size
+        :param int width: Width of composed image
+        :param int height: Height of composed image
+        :param str mode: Image mode of composed image (RGB|RGBA)
+        """
+        # NOTE: images are opened lazily and only decoded when joined or
+        #       pasted
+        entries = [entry for entry in imgdata if entry["size"]]
+
+        if width * height <= IMAGE_JOIN_PIXELS_MAX and all(
+            entry["image"].mode == mode and entry["image"].width == width and
+            'transparency' not in entry["image"].info
+            for entry in entries
+        ):
+            # join raw pixel rows if all images already match the composed
+            # image, instead of filling and pasting into a blank canvas
+            rows = []
+            for entry in entries:
+                img = entry.pop("image")
+                rows.append(img.tobytes())
+                img.close()
+            return Image.frombytes(mode, (width, height), b''.join(rows))
+
+        image = Image.new(mode, (width, height), (255,) * len(mode))
         y = 0
+        for entry in entries:
+            img = entry.pop("image")
+            if mode == "RGB" and self.image_has_alpha(img):
+                # remove alpha channel by blending onto white canvas,
+                # using a single masked paste
+                # NOTE: also blend other modes with alpha or transparency,
+                #       like when flattening with pyvips
+                rgba = img if img.mode == "RGBA" else img.convert("RGBA")
+                image.paste(rgba, (0, y), rgba)
+                if rgba is not img:
+                    rgba.close()
+            else:
+                image.paste(img, (0, y))
+            y += img.height
+            # NOTE: release decoded image right after pasting it,
+            #       so that only one decoded image is kept at a time
+            img.close()
+
+        return image
+
+    def compose_images_vips(self, imgdata, width, has_alpha, format_param):
+        """Compose legend images vertically using libvips and return the
+        encoded image.
+
+        :param list(obj) imgdata: Image entries with data and size
+        :param int width: Width of composed image
+        :param bool has_alpha: Whether to keep an alpha channel
+        :param str format_param: Image format
+        """
+        background = [255, 255, 255, 255] if has_alpha else [255, 255, 255]
+        images = []
         for entry in imgdata:
-            if entry["image"]:
-                image.paste(entry["image"], (0, y))
-                y += entry["image"].height
+            if not entry["size"]:
+                continue
+
+            img = pyvips.Image.new_from_buffer(
+                entry["data"], "", access="sequential"
+            )
+            # convert to 8-bit sRGB
+            img = img.colourspace("srgb")
+            if has_alpha and not img.hasalpha():
+                img = img.bandjoin(255)
+            elif not has_alpha and img.hasalpha():
+                img = img.flatten(background=[255, 255, 255])
+            # pad to common width with white background
+            img = img.embed(
+                0, 0, width, img.height, extend="background",
+                background=background
+            )
+            images.append(img)
+
+        # NOTE: arrayjoin uses uniform cell sizes, so join images one by one
+        image = images[0]
+        for img in images[1:]:
+            image = image.join(img, "vertical")
+
+        return image.write_to_buffer(VIPS_SAVE_FORMATS[format_param])
+
+    def layer_legend_images(self, service_name, expanded_layer_styles,
+                            format_param, params, type):
+        """Return legend image entries for layers in order of expanded layers,
+        either from custom legend images or from the QGIS server.
+
+        Entries are {"data": <bytes>, "format": <format or None>} or None,
+        with any "path" of an unmodified custom legend image file,
+        and "fallback" set for fallback images after server errors.
+
+        :param str service_name: Service name
+        :param list(obj) expanded_layer_styles: Layer and style names
+        :param str format_param: Image format
+        :param dict params: Other params to forward to QGIS Server
+        :param str type: The legend image type
+        """
+        results = []
+        # pending QGIS server requests as [(<index>, <layer>, <params>)]
+        fetches = []
+        for layer_style in expanded_layer_styles:
+            layer = layer_style['layer']
+            legend_image = self.get_legend_image(service_name, layer, type)
+            if legend_image is not None:
+                results.append(
+                    self.custom_legend_image(layer, legend_image, params)
+                )
+                continue
+
+            req_params = {
+                "service": "WMS",
+                "version": "1.3.0",
+                "request": "GetLegendGraphic",
+                "layer": layer,
+                "format": format_param,
+                "style": layer_style['style']
+            }
+            req_params.update(params)
+            if self.legend_default_font_size:
+                if 'layerfontsize' not in req_params:
+                    req_params['layerfontsize'] = \
+                        self.legend_default_font_size
+                if 'itemfontsize' not in req_params:
+                    req_params['itemfontsize'] = \
+                        self.legend_default_font_size
+            # check for cached legend image
+            cache_key = (service_name, tuple(sorted(req_params.items())))
+            legend_image = self.legend_cache.get(cache_key)
+            if legend_image is not None:
+                results.append({"data": legend_image, "format": format_param})
+                continue
+
+            fetches.append((len(results), layer, req_params, cache_key))
+            results.append(None)
+
+        def request_image(pending):
+            index, layer, req_params, cache_key = pending
+            return self.remote_legend_image(
+                service_name, layer, req_params, format_param, cache_key
+            )
+
+        if len(fetches) > 1:
+            # request legend images of multiple layers concurrently
+            entries = self.executor.map(request_image, fetches)
+        else:
+            entries = map(request_image, fetches)
+        for pending, entry in zip(fetches, entries):
+            results[pending[0]] = entry
+
+        return results
+
+    def custom_legend_image(self, layer, legend_image, params):
+        """Return legend image entry for a custom legend image,
+        scaled to any requested DPI.
+
+        :param str layer: WMS layer name
+        :param tuple legend_image: Custom legend image as (<path>, <data>)
+        :param dict params: Other params to forward to QGIS Server
+        """
+        image_path, legend_image = legend_image
+        dpi = params.get('dpi')
+        if dpi and dpi != '90':
+            cache_key = (legend_image, dpi)
+            scaled_image = self.scaled_images_cache.get(cache_key)
+            if scaled_image is not None:
+                return {"data": scaled_image, "format": "image/png"}
+            try:
+                # scale image to requested DPI
+                img = Image.open(BytesIO(legend_image))
+                scale = float(dpi) / 90.0
+                new_size = (
+                    int(img.width * scale), int(img.height * scale)
+                )
+                # NOTE: let the JPEG decoder downscale while decoding,
+                #       no-op for other formats or when upscaling
+                img.draft(img.mode, new_size)
+                img = img.resize(new_size, self.resample_filter)
+                output = BytesIO()
+                # NOTE: save as PNG to preserve any alpha channel
+                img.save(output, "PNG", **PIL_SAVE_OPTIONS["PNG"])
+                scaled_image = output.getvalue()
+                self.scaled_images_cache.set(cache_key, scaled_image)
+                return {"data": scaled_image, "format": "image/png"}
+            except Exception as e:
+                self.logger.error(
+                    "Could not resize image for %s:\n%s" % (layer, e)
+                )
+                return {
+                    "data": legend_image,
+                    "format": self.image_format(legend_image)
+                }
+        else:
+            return {
+                "data": legend_image,
+                "format": self.image_format(legend_image),
+                "path": image_path
+            }
+
+    def remote_legend_image(self, service_name, layer, req_params,
+                            format_param, cache_key):
+        """Return legend image entry for a single layer from the QGIS server.
+
+        :param str service_name: Service name
+        :param str layer: WMS layer name
+        :param dict req_params: GetLegendGraphic params
+        :param str format_param: Image format
+        :param tuple cache_key: Key for legend image cache
+        """
+        # wait for any concurrent request for the same legend image
+        # NOTE: only the first request is forwarded to the QGIS server
+        with self.legend_fetches_lock:
+            fetch = self.legend_fetches.get(cache_key)
+            pending = fetch is not None
+            if not pending:
+                fetch = self.legend_fetches[cache_key] = Future()
+        if pending:
+            entry = fetch.result()
+            # NOTE: return a copy, as entries may be modified
+            return dict(entry) if entry is not None else None
+
+        try:
+            entry = self.fetch_legend_image(
+                service_name, layer, req_params, format_param, cache_key
+            )
+            fetch.set_result(entry)
+            return dict(entry) if entry is not None else None
+        except Exception as e:
+            fetch.set_exception(e)
+            raise
+        finally:
+            with self.legend_fetches_lock:
+                del self.legend_fetches[cache_key]
+
+    def fetch_legend_image(self, service_name, layer, req_params,
+                           format_param, cache_key):
+        """Request legend image for a single layer from the QGIS server
+        and cache it.
+
+        Returns {"data": <bytes>, "format": <format>} or None.
+
+        :param str service_name: Service name
+        :param str layer: WMS layer name
+        :param dict req_params: GetLegendGraphic params
+        :param str format_param: Image format
+        :param tuple cache_key: Key for legend image cache
+        """
+        try:
+            response = self.session.get(
+                self.qgis_server_url + service_name, params=req_params,
+                timeout=30
+            )
+        except requests.RequestException as e:
+            # QGIS server not reachable or timed out
+            return self.fallback_legend_image(
+                layer, format_param, cache_key, e
+            )
+        self.logger.debug("Forwarding request to %s", response.url)
+
+        if response.content.startswith(b'<ServiceExceptionReport'):
+            self.logger.warning(response.content)
+            return None
+        elif response.status_code == 200:
+            self.legend_cache.set(cache_key, response.content)
+            return {"data": response.content, "format": format_param}
+        else:
+            return self.fallback_legend_image(
+                layer, format_param, cache_key,
+                "server error %s" % response.status_code
+            )
+
+    def fallback_legend_image(self, layer, format_param, cache_key, error):
+        """Return fallback legend image entry after a failed QGIS server
+        request, using any expired cached legend image or an empty image.
+
+        :param str layer: WMS layer name
+        :param str format_param: Image format
+        :param tuple cache_key: Key for legend image cache
+        :param obj error: Server error or exception
+        """
+        # use any expired cached legend image in case of server error
+        legend_image = self.legend_cache.get_stale(cache_key)
+        if legend_image is not None:
+            self.logger.warning(
+                "Using cached legend image for layer '%s' after "
+                "%s" % (layer, error)
+            )
+            return {
+                "data": legend_image, "format": format_param,
+                "fallback": True
+            }
+
+        # Empty image in case of server error
+        self.logger.warning(
+            "Could not get legend image for layer '%s': %s" % (layer, error)
+        )
+        return {
+            "data": empty_image(PIL_Formats[format_param]),
+            "format": format_param,
+            "fallback": True
+        }
+
+    def expanded_layer_styles(self, service_name, layer_param, styles_param,
+                              permitted_resources):
+        """Return permitted requested layers and styles, with group layers
+        replaced by their permitted sublayers where required.
+
+        Results are cached per service, permitted layers and request params.
+
+        :param str service_name: Service name
+        :param str layer_param: WMS layer names
+        :param str styles_param: WMS layer styles
+        :param obj permitted_resources: Permitted resources for identity
+        """
+        # NOTE: permitted resources only depend on the permitted layers
+        permitted_layers = permitted_resources['permitted_layers']
+        cache_key = (service_name, permitted_layers, layer_param, styles_param)
+        expanded_layer_styles = self.expanded_layers_cache.get(cache_key)
+        if expanded_layer_styles is not None:
+            return expanded_layer_styles
 
-        data = BytesIO()
-        image.save(data, PIL_Formats[format_param])
-        data.seek(0)
-        return send_file(data, mimetype=format_param)
+        requested_layers = layer_param.split(',')
+        requested_layer_styles = self.padded_styles(requested_layers, styles_param)
+        public_layers = permitted_resources['public_layers']
+        group_leaves = permitted_resources['group_leaves']
+        # filter layers by permissions
+        requested_layer_styles = [
+            entry for entry in requested_layer_styles
+            if entry['layer'] in public_layers
+        ]
+        # replace group layers containing custom legends with permitted
+        # sublayers
+        expanded_layer_styles = self.expand_group_layers(
+            requested_layer_styles, group_leaves, permitted_layers
+        )
+
+        self.logger.debug("Requested layers: %s", requested_layers)
+        self.logger.debug("Expanded layers:  %s", expanded_layer_styles)
+
+        self.expanded_layers_cache.set(cache_key, expanded_layer_styles)
+        return expanded_layer_styles
 
     def padded_styles(self, requested_layers, styles_param):
         """Complement requested styles to match number of requested layers.
@@ -280,74 +902,76 @@ class LegendService:
             status=200
         )
 
-    def expand_group_layers(self, requested_layer_styles, groups_to_expand,
+    def expand_group_layers(self, requested_layer_styles, group_leaves,
                             permitted_layers):
-        """Recursively filter layers by permissions and replace group layers
-        with permitted sublayers and return resulting layer list.
+        """Filter layers by permissions and replace group layers with their
+        permitted leaf sublayers and return resulting layer list.
 
         :param list(str) requested_layer_styles: List of requested layer and style names
-        :param obj groups_to_expand: Lookup for group layers with sublayers
-                                     that have custom legends or are restricted
-        :param list(str) permitted_layers: List of permitted layer names
+        :param obj group_leaves: Lookup for flattened permitted sublayers of
+                                 group layers that have to be expanded
+        :param frozenset(str) permitted_layers: Set of permitted layer names
         """
         expanded_layers = []
-
         for entry in requested_layer_styles:
-            if entry['layer'] in permitted_layers:
-                if entry['layer'] in groups_to_expand:
-                    # expand sublayers
-                    sublayers = []
-                    for sublayer in groups_to_expand.get(entry['layer']):
-                        if sublayer in permitted_layers:
-                            sublayers.append({'layer': sublayer, 'style': ''})
-
-                    expanded_layers += self.expand_group_layers(
-                        sublayers, groups_to_expand, permitted_layers
-                    )
-                else:
-                    # leaf layer or full group layer
-                    expanded_layers.append(entry)
+            if entry['layer'] not in permitted_layers:
+                continue
+
+            leaves = group_leaves.get(entry['layer'])
+            if leaves is not None:
+                # expand permitted sublayers
+                expanded_layers.extend(
+                    {'layer': sublayer, 'style': ''} for sublayer in leaves
+                )
+            else:
+                # leaf layer or full group layer
+                expanded_layers.append(entry)
 
         return expanded_layers
 
     def get_legend_image(self, service_name, layer, type):
-        """Return any custom legend image for a layer.
+        """Return any custom legend image for a layer as (<path>, <data>),
+        using cached lookups.
 
         :param str service_name: Service name
         :param str layer: WMS Layer name
         :param str type: Legend image type (default|thumbnail|tooltip)
         """
-        image_data = None
+        # NOTE: also cache missing legend images as None
+        cache_key = (service_name, layer, type)
+        image_data = self.legend_images_cache.get(cache_key, MISSING)
+        if image_data is MISSING:
+            image_data = self.find_legend_image(service_name, layer, type)
+            self.legend_images_cache.set(cache_key, image_data)
 
-        # attempt to match legend image by filename
-        filenames = []
-        allowempty = False
+        return image_data
 
-        if type == "thumbnail":
-            filenames.append(os.path.join(service_name, layer + "_thumbnail.png"))
-        elif type == "tooltip":
-            filenames.append(os.path.join(service_name, layer + "_tooltip.png"))
-            allowempty = True
+    def find_legend_image(self, service_name, layer, type):
+        """Look up any custom legend image for a layer
+        and return it as (<path>, <data>) or None.
 
-        filenames.append(os.path.join(service_name, layer + '.png'))
+        :param str service_name: Service name
+        :param str layer: WMS Layer name
+        :param str type: Legend image type (default|thumbnail|tooltip)
+        """
 
-        for filename in filenames:
-            try:
-                image_path = os.path.join(self.legend_images_path, filename)
-                self.logger.debug(
-                    "Looking for legend image '%s' for layer '%s'..." % (image_path, layer)
-                )
-                data = open(os.path.join(self.legend_images_path, filename), 'rb').read()
-                if data or allowempty:
-                    self.logger.debug(
-                        "Loading legend image '%s' for layer '%s'" % (image_path, layer)
-                    )
-                    return data
-            except:
-                pass
+        wms_resources = self.resources['wms_services'][service_name]
+
+        # attempt to match legend image by filename
+        candidate_files = wms_resources['legend_candidate_files'].get(layer)
+        if candidate_files is None:
+            candidate_files = self.candidate_files(
+                os.path.join(self.legend_images_path, service_name), layer
+            )
+        filenames, allowempty = candidate_files.get(
+            type, candidate_files['default']
+        )
+
+        legend_image = self.find_legend_file(filenames, allowempty, layer)
+        if legend_image is not None:
+            return legend_image
 
         # get lookup for custom legend images
-        wms_resources = self.resources['wms_services'][service_name]
         legend_images = wms_resources['legend_images']
         if layer in legend_images:
             # TODO: legend image types
@@ -357,15 +981,14 @@ class LegendService:
                     self.legend_images_path, legend_images[layer]
                 )
                 self.logger.debug(
-                    "Looking for legend image '%s' (defined in resources) for layer '%s'..." % (image_path, layer)
+                    "Looking for legend image '%s' (defined in resources) for layer '%s'...", image_path, layer
                 )
-                if os.path.isfile(image_path):
+                if self.legend_file_exists(image_path):
                     self.logger.debug(
-                        "Loading legend image '%s' for layer '%s'" % (image_path, layer)
+                        "Loading legend image '%s' for layer '%s'", image_path, layer
                     )
                     # load image file
-                    with open(image_path, 'rb') as f:
-                        return f.read()
+                    return (image_path, self.read_legend_file(image_path))
                 else:
                     self.logger.warning(
                         "Could not find legend image '%s' for layer '%s'" %
@@ -378,30 +1001,128 @@ class LegendService:
                 )
 
         # Look for fallback default images
-        filenames = []
-        if type == "thumbnail":
-            filenames.append("default_thumbnail.png")
-        elif type == "tooltip":
-            filenames.append("default_tooltip.png")
-            allowempty = True
-        filenames.append('default.png')
-
-        for filename in filenames:
+        filenames, allowempty = self.default_candidate_files.get(
+            type, self.default_candidate_files['default']
+        )
+
+        legend_image = self.find_legend_file(filenames, allowempty, layer)
+        if legend_image is not None:
+            return legend_image
+
+        self.logger.debug("No custom legend image of type '%s' found for layer '%s'", type, layer)
+        return None
+
+    def find_legend_file(self, filenames, allowempty, layer):
+        """Return first existing legend image file of candidate files
+        as (<path>, <data>) or None.
+
+        :param list(str) filenames: Candidate legend image files
+        :param bool allowempty: Whether to accept empty files
+        :param str layer: WMS Layer name
+        """
+        for image_path in filenames:
+            self.logger.debug(
+                "Looking for legend image '%s' for layer '%s'...", image_path, layer
+            )
+            # NOTE: check cached dir listing instead of handling
+            #       exceptions for missing files
+            if not self.legend_file_exists(image_path):
+                continue
             try:
-                image_path = os.path.join(self.legend_images_path, filename)
+                data = self.read_legend_file(image_path)
+            except OSError as e:
+                self.logger.warning(
+                    "Could not read legend image '%s': %s", image_path, e
+                )
+                continue
+            if data or allowempty:
                 self.logger.debug(
-                    "Looking for legend image '%s' for layer '%s'..." % (image_path, layer)
+                    "Loading legend image '%s' for layer '%s'", image_path, layer
                 )
-                data = open(os.path.join(self.legend_images_path, filename), 'rb').read()
-                if data or allowempty:
-                    self.logger.debug(
-                        "Loading legend image '%s' for layer '%s'" % (image_path, layer)
+                return (image_path, data)
+
+        return None
+
+    def candidate_files(self, dir_path, basename):
+        """Return candidate legend image files for each legend image type
+        in lookup order, as {<type>: (<absolute paths>, <allowempty>)}.
+
+        :param str dir_path: Absolute path to legend images dir
+        :param str basename: Base file name without suffix
+        """
+        image_path = os.path.join(dir_path, basename + '.png')
+        return {
+            'default': ((image_path,), False),
+            'thumbnail': ((
+                os.path.join(dir_path, basename + '_thumbnail.png'),
+                image_path
+            ), False),
+            'tooltip': ((
+                os.path.join(dir_path, basename + '_tooltip.png'),
+                image_path
+            ), True)
+        }
+
+    def legend_file_exists(self, image_path):
+        """Return whether legend image file exists, using a cached listing
+        of the files in its directory.
+
+        :param str image_path: Path to legend image file
+        """
+        dir_path, filename = os.path.split(image_path)
+        filenames = self.legend_dirs_cache.get(dir_path)
+        if filenames is None:
+            try:
+                # NOTE: file types are mostly known from the dir entries
+                #       without additional stat calls
+                with os.scandir(dir_path) as entries:
+                    filenames = frozenset(
+                        entry.name for entry in entries if entry.is_file()
                     )
-                    return data
-            except:
-                pass
+            except OSError:
+                # dir not found
+                filenames = frozenset()
+            self.legend_dirs_cache.set(dir_path, filenames)
+
+        return filename in filenames
+
+    def read_legend_file(self, image_path):
+        """Return contents of legend image file, cached until file changes.
+
+        Raises OSError if file could not be read.
+
+        :param str image_path: Path to legend image file
+        """
+        cache_key = (image_path, os.stat(image_path).st_mtime_ns)
+        data = self.legend_files_cache.get(cache_key)
+        if data is None:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+            self.legend_files_cache.set(cache_key, data)
+
+        return data
+
+    def image_format(self, data):
+        """Return image format of image data detected from its file
+        signature, or None if unknown.
+
+        :param bytes data: Image data
+        """
+        header = data[:8]
+        for signature, format in IMAGE_SIGNATURES:
+            if header.startswith(signature):
+                return format
+
+        if header.startswith(b'RIFF') and data[8:12] == b'WEBP':
+            return "image/webp"
+
+        if (
+            header.startswith(b'BM') and len(data) >= 18 and
+            int.from_bytes(data[14:18], 'little') in BMP_DIB_HEADER_SIZES
+        ):
+            # BITMAPFILEHEADER followed by a DIB header of known size
+            return "image/bmp"
 
-        self.logger.debug("No custom legend image of type '%s' found for layer '%s'" % (type, layer))
         return None
 
     def format_has_alpha(self, format_param):
@@ -411,15 +1132,31 @@ class LegendService:
         """
         return format_param in FORMATS_WITH_ALPHA
 
+    def image_has_alpha(self, image):
+        """Return whether image has an alpha channel or transparency.
+
+        :param Image image: Input image
+        """
+        return (
+            image.mode in ('RGBA', 'RGBa', 'LA', 'La', 'PA') or
+            'transparency' in image.info
+        )
+
     def convert_img_to_rgb(self, image):
         """Return image as RGB, converting from RGBA if necessary.
 
         :param Image image: Input image
         """
         if image.mode == 'RGBA':
-            # remove alpha channel by compositing with white background
-            background = Image.new("RGBA", image.size, (255, 255, 255, 255))
-            image = Image.alpha_composite(background, image).convert("RGB")
+            if image.getextrema()[3][0] == 255:
+                # alpha channel is fully opaque, just drop it
+                return image.convert("RGB")
+
+            # remove alpha channel by blending onto white background,
+            # using a single masked paste
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, (0, 0), image)
+            image = background
 
         return image
 
@@ -436,12 +1173,13 @@ class LegendService:
             resources = {
                 # root layer name
                 'root_layer': wms['root_layer']['name'],
-                # public layers without hidden sublayers: [<layers>]
+                # public layers without hidden sublayers: {<layers>}
                 'public_layers': [],
-                # available layers including hidden sublayers: [<layers>]
+                # available layers including hidden sublayers: {<layers>}
                 'available_layers': [],
                 # lookup for complete group layers
-                # sub layers ordered from top to bottom:
+                # sub layers ordered from top to bottom,
+                # groups in post-order (sublayer groups before parents):
                 #     {<group>: [<sub layers]}
                 'group_layers': {},
                 # lookup for group layers containing layers with
@@ -449,14 +1187,57 @@ class LegendService:
                 # sub layers ordered from top to bottom:
                 #     {<group>: [<sub layers]}
                 'groups_to_expand': {},
+                # lookup for flattened sublayers of groups to expand,
+                # with nested groups to expand replaced by their sublayers:
+                #     {<group>: (<sub layers>)}
+                'group_leaves': {},
                 # lookup for layers with custom legend images:
                 #     {<layer>: <legend img>}
-                'legend_images': {}
+                'legend_images': {},
+                # lookup for candidate legend image files by type:
+                #     {<layer>: {<type>: (<absolute paths>, <allowempty>)}}
+                'legend_candidate_files': {}
             }
             self.collect_layers(wms['root_layer'], resources, False)
 
+            # precompute candidate legend image files for all layers
+            service_dir = os.path.join(self.legend_images_path, wms['name'])
+            for layer in resources['available_layers']:
+                resources['legend_candidate_files'][layer] = \
+                    self.candidate_files(service_dir, layer)
+
+            # freeze lookups, as they do not change after loading
+            resources['public_layers'] = frozenset(
+                resources['public_layers']
+            )
+            resources['available_layers'] = frozenset(
+                resources['available_layers']
+            )
+            resources['group_layers'] = {
+                group: tuple(sublayers)
+                for group, sublayers in resources['group_layers'].items()
+            }
+            resources['groups_to_expand'] = {
+                group: tuple(sublayers)
+                for group, sublayers in resources['groups_to_expand'].items()
+            }
+            # NOTE: all sublayers are permitted if no layers are restricted
+            resources['group_leaves'] = self.collect_group_leaves(
+                resources['group_layers'], resources['groups_to_expand'],
+                resources['available_layers']
+            )
+
             wms_services[wms['name']] = resources
 
+        if self.base64_images_dir not in (MISSING, None):
+            # remove extracted Base64 legend images no longer in config
+            self.prune_base64_images(set(
+                image_path
+                for resources in wms_services.values()
+                for image_path in resources['legend_images'].values()
+                if os.path.dirname(image_path) == self.base64_images_dir
+            ))
+
         return {
             'wms_services': wms_services
         }
@@ -523,11 +1304,101 @@ class LegendService:
             # relative path to legend_images_path
             image_path = layer.get('legend_image')
         elif layer.get('legend_image_base64'):
-            # absolute path to images_temp_dir
+            # absolute path in Base64 images dir
             image_path = self.extract_base64_legend_image(layer)
 
         return image_path
 
+    def private_base64_images_dir(self):
+        """Return private dir for Base64 encoded legend images of this tenant,
+        falling back to a temporary dir if base64_images_path is not usable,
+        or None if no dir is available.
+        """
+        try:
+            return self.private_dir(self.base64_images_path, self.tenant)
+        except OSError as e:
+            self.logger.warning(
+                "Could not use base64_images_path '%s', falling back to "
+                "temporary dir:\n%s" % (self.base64_images_path, e)
+            )
+
+        global BASE64_FALLBACK_DIR
+        try:
+            with BASE64_FALLBACK_LOCK:
+                if BASE64_FALLBACK_DIR is None:
+                    BASE64_FALLBACK_DIR = tempfile.TemporaryDirectory(
+                        prefix='qwc-legend-service-'
+                    )
+            return self.private_dir(BASE64_FALLBACK_DIR.name, self.tenant)
+        except OSError as e:
+            self.logger.error(
+                "Could not create temporary dir for Base64 images:\n%s" % e
+            )
+            return None
+
+    def private_dir(self, base_dir, name):
+        """Create private subdir in base dir if missing and return its path.
+
+        Raise OSError if the subdir name is not a single path segment, or if
+        the base dir or subdir is not owned by this process or writable by
+        others, as their files could then be swapped.
+
+        :param str base_dir: Base dir
+        :param str name: Subdir name
+        """
+        if name in ('', '.', '..') or os.path.basename(name) != name:
+            # NOTE: e.g. tenant names from request headers must not select
+            #       dirs outside of base dir or shared by other tenants
+            raise OSError("Invalid subdir name '%s'" % name)
+
+        dir_path = os.path.join(base_dir, name)
+        os.makedirs(base_dir, mode=0o700, exist_ok=True)
+        try:
+            os.mkdir(dir_path, mode=0o700)
+        except FileExistsError:
+            pass
+
+        for path in (base_dir, dir_path):
+            # NOTE: do not follow symlinks
+            st = os.lstat(path)
+            if not stat.S_ISDIR(st.st_mode):
+                raise OSError("'%s' is not a directory" % path)
+            if st.st_uid != os.getuid():
+                raise OSError("'%s' is not owned by this service" % path)
+            if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise OSError("'%s' is writable by others" % path)
+
+        return dir_path
+
+    def prune_base64_images(self, image_paths):
+        """Remove extracted Base64 encoded legend images of this tenant
+        except the specified ones.
+
+        NOTE: other service instances with outdated config may still briefly
+              look up removed images until they are reloaded
+
+        :param set(str) image_paths: Paths of images to keep
+        """
+        try:
+            with os.scandir(self.base64_images_dir) as it:
+                for entry in it:
+                    if (
+                        entry.name.endswith('.png') and
+                        entry.path not in image_paths
+                    ):
+                        try:
+                            os.remove(entry.path)
+                        except OSError as e:
+                            self.logger.warning(
+                                "Could not remove Base64 legend image "
+                                "'%s': %s", entry.path, e
+                            )
+        except OSError as e:
+            self.logger.warning(
+                "Could not clean up Base64 images dir '%s': %s",
+                self.base64_images_dir, e
+            )
+
     def extract_base64_legend_image(self, layer):
         """Extract Base64 encoded legend image to file and return its path.
 
@@ -536,17 +1407,39 @@ class LegendService:
         image_path = None
 
         try:
-            if self.images_temp_dir is None:
-                # create temporary target dir
-                self.images_temp_dir = tempfile.TemporaryDirectory(
-                    prefix='qwc-legend-service-'
+            if self.base64_images_dir is MISSING:
+                self.base64_images_dir = self.private_base64_images_dir()
+            if self.base64_images_dir is None:
+                raise OSError("No private dir for Base64 images available")
+
+            legend_image_base64 = layer.get('legend_image_base64').encode()
+            digest = hashlib.blake2b(
+                legend_image_base64, digest_size=16
+            ).hexdigest()
+            image_path = os.path.join(
+                self.base64_images_dir, "%s.png" % digest
+            )
+            if not os.path.isfile(image_path):
+                # decode and save as image file
+                # NOTE: write to temp file first and rename it, so other
+                #       processes never read a partially written file
+                fd, temp_path = tempfile.mkstemp(
+                    suffix='.tmp', dir=self.base64_images_dir
                 )
-
-            # decode and save as image file
-            filename = "%s-%s.png" % (layer['name'], uuid.uuid4())
-            image_path = os.path.join(self.images_temp_dir.name, filename)
-            with open(image_path, 'wb') as f:
-                f.write(base64.b64decode(layer.get('legend_image_base64')))
+                try:
+                    try:
+                        # NOTE: write decoded data without buffered file copy
+                        data = memoryview(
+                            binascii.a2b_base64(legend_image_base64)
+                        )
+                        while data:
+                            data = data[os.write(fd, data):]
+                    finally:
+                        os.close(fd)
+                    os.replace(temp_path, image_path)
+                except Exception:
+                    os.remove(temp_path)
+                    raise
         except Exception as e:
             image_path = None
             self.logger.error(
@@ -556,114 +1449,143 @@ class LegendService:
 
         return image_path
 
-    def wms_permitted(self, service_name, identity):
-        """Return whether WMS is available and permitted.
+    def permitted_resources(self, service_name, identity):
+        """Return permitted resources for a legend service,
+        or None if WMS is unknown or not permitted.
+
+        Results are cached per service and identity roles.
 
         :param str service_name: Service name
         :param obj identity: User identity
         """
-        if self.resources['wms_services'].get(service_name):
-            # get permissions for WMS
-            wms_permissions = self.permissions_handler.resource_permissions(
-                'wms_services', identity, service_name
+        if not self.resources['wms_services'].get(service_name):
+            # WMS service unknown
+            return None
+
+        # NOTE: permissions only depend on the roles of the identity
+        roles = self.permissions_handler.identity_roles(identity)
+        cache_key = (service_name, tuple(roles))
+        permitted_resources = self.permitted_resources_cache.get(
+            cache_key, MISSING
+        )
+        if permitted_resources is MISSING:
+            permitted_resources = self.collect_permitted_resources(
+                service_name, identity
             )
-            if wms_permissions:
-                return True
+            self.permitted_resources_cache.set(cache_key, permitted_resources)
 
-        return False
+        return permitted_resources
 
-    def permitted_resources(self, service_name, identity):
-        """Return permitted resources for a legend service.
+    def collect_permitted_resources(self, service_name, identity):
+        """Collect permitted resources for a legend service,
+        or None if WMS is not permitted.
+
+        NOTE: returned lookups are shared and must not be modified
 
         :param str service_name: Service name
         :param obj identity: User identity
         """
-        if not self.resources['wms_services'].get(service_name):
-            # WMS service unknown
-            return {}
-
         # get permissions for WMS
         wms_permissions = self.permissions_handler.resource_permissions(
             'wms_services', identity, service_name
         )
         if not wms_permissions:
             # WMS not permitted
-            return {}
+            return None
 
-        wms_resources = self.resources['wms_services'][service_name].copy()
+        # NOTE: resources are shared and must not be modified
+        wms_resources = self.resources['wms_services'][service_name]
 
         # get available layers
         available_layers = wms_resources['available_layers']
 
         # combine permissions
-        permitted_layers = set()
-        for permission in wms_permissions:
-            for layer in permission['layers']:
-                name = layer['name']
-                if name in available_layers:
-                    permitted_layers.add(name)
+        permitted_layers = available_layers.intersection(
+            layer['name']
+            for permission in wms_permissions
+            for layer in permission['layers']
+        )
 
         # filter by permissions
 
         # public layers
-        public_layers = [
-            layer for layer in wms_resources['public_layers']
-            if layer in permitted_layers
-        ]
+        public_layers = wms_resources['public_layers'] & permitted_layers
 
         # collect restricted group layers
         restricted_group_layers = {}
-        self.collect_restricted_group_layers(
-            wms_resources['root_layer'], wms_resources['group_layers'],
-            permitted_layers, restricted_group_layers
-        )
+        if len(permitted_layers) < len(available_layers):
+            restricted_group_layers = self.collect_restricted_group_layers(
+                wms_resources['group_layers'], permitted_layers
+            )
         # merge with groups to expand
-        groups_to_expand = wms_resources['groups_to_expand']
-        for group, allowed_sublayers in restricted_group_layers.items():
-            # update with allowed layers
-            groups_to_expand[group] = allowed_sublayers
+        group_leaves = wms_resources['group_leaves']
+        if restricted_group_layers:
+            # NOTE: copy lookup, as it is shared between identities
+            groups_to_expand = wms_resources['groups_to_expand'].copy()
+            for group, allowed_sublayers in restricted_group_layers.items():
+                # update with allowed layers
+                groups_to_expand[group] = allowed_sublayers
+            group_leaves = self.collect_group_leaves(
+                wms_resources['group_layers'], groups_to_expand,
+                permitted_layers
+            )
 
         return {
-            'permitted_layers': sorted(list(permitted_layers)),
+            'permitted_layers': permitted_layers,
             'public_layers': public_layers,
-            'groups_to_expand': groups_to_expand
+            'group_leaves': group_leaves
         }
 
-    def collect_restricted_group_layers(self, layer, group_layers,
-                                        permitted_layers,
-                                        restricted_group_layers):
-        """Recursively collect group layers with restricted sublayers.
+    def collect_group_leaves(self, group_layers, groups_to_expand,
+                             permitted_layers):
+        """Return lookup for groups to expand with their flattened permitted
+        sublayers, with nested groups to expand replaced by their sublayers.
 
-        :param str layer: Layer name
-        :param obj group_layers: Lookup for group layers
-        :param list(str) permitted_layers: List of permitted layer names
-        :Param obj restricted_group_layers: Partial lookup for restricted
-                                            group layers
+        :param obj group_layers: Lookup for group layers in post-order
+        :param obj groups_to_expand: Lookup for group layers with sublayers
+                                     that have custom legends or are restricted
+        :param set(str) permitted_layers: Set of permitted layer names
         """
-        if layer in group_layers:
-            # group layer
+        group_leaves = {}
+        # NOTE: sublayer groups are always visited before their parent group
+        for group in group_layers:
+            sublayers = groups_to_expand.get(group)
+            if sublayers is None:
+                continue
+
+            leaves = []
+            for sublayer in sublayers:
+                if sublayer not in permitted_layers:
+                    continue
+                if sublayer in group_leaves:
+                    leaves.extend(group_leaves[sublayer])
+                else:
+                    leaves.append(sublayer)
+            group_leaves[group] = tuple(leaves)
 
-            # collect sublayers
-            sublayers = []
-            sublayers_restricted = False
-            for sublayer in group_layers[layer]:
-                if sublayer in permitted_layers:
-                    # add permitted layer
-                    sublayers.append(sublayer)
+        return group_leaves
 
-                # recursively collect sublayer
-                self.collect_restricted_group_layers(
-                    sublayer, group_layers, permitted_layers,
-                    restricted_group_layers
-                )
-                if (
-                    sublayer not in permitted_layers or
-                    sublayer in restricted_group_layers
-                ):
-                    # sublayer is restricted
-                    # or is a group containing such sublayers
-                    sublayers_restricted |= True
+    def collect_restricted_group_layers(self, group_layers,
+                                        permitted_layers):
+        """Return lookup for group layers with restricted sublayers,
+        with their permitted sublayers.
 
-            if sublayers_restricted:
-                # group has restricted sublayers
-                restricted_group_layers[layer] = sublayers
+        :param obj group_layers: Lookup for group layers in post-order
+        :param set(str) permitted_layers: Set of permitted layer names
+        """
+        restricted_group_layers = {}
+        # NOTE: sublayer groups are always visited before their parent group
+        for group, sublayers in group_layers.items():
+            if permitted_layers.issuperset(sublayers) and not any(
+                sublayer in restricted_group_layers for sublayer in sublayers
+            ):
+                # all sublayers permitted and unrestricted
+                continue
+
+            # group has restricted sublayers
+            restricted_group_layers[group] = [
+                sublayer for sublayer in sublayers
+                if sublayer in permitted_layers
+            ]
+
+        return restricted_group_layers
@@ -1,18 +1,24 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+from threading import Lock
+import time
 
-from flask import Flask, jsonify, json
-from flask_restx import Api, Resource, reqparse
+from PIL import Image
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from qwc_services_core.api import CaseInsensitiveArgument
-from qwc_services_core.app import app_nocache
+from flask import Flask, Response, request
+from flask_restx import Api, Resource
 from qwc_services_core.auth import auth_manager, optional_auth, get_identity
 from qwc_services_core.tenant_handler import TenantHandler
 from legend_service import LegendService
+from ttl_cache import TTLCache
 
 
 # Flask application
 app = Flask(__name__)
-app_nocache(app)
 api = Api(app, version='1.0', title='Legend service API',
           description="""API for QWC Legend service.
 
@@ -26,17 +32,85 @@ app.config['ERROR_404_HELP'] = False
 
 auth = auth_manager(app, api)
 
+# number of freed image memory blocks kept by PIL for reuse
+# NOTE: canvas and converted images of composed legends then reuse the
+#       memory of previous requests instead of allocating new memory
+IMAGE_BLOCKS_MAX = 16
+if 'PILLOW_BLOCKS_MAX' not in os.environ:
+    # NOTE: keep any blocks max set via environment
+    Image.core.set_blocks_max(IMAGE_BLOCKS_MAX)
+
 # create tenant handler
 tenant_handler = TenantHandler(app.logger)
 
+# lookup for legend service handlers as
+#     {<tenant>: (<time of next config check>, <handler>)}
+# NOTE: config files are checked for changes at most once per interval
+HANDLERS = {}
+HANDLERS_LOCK = Lock()
+CONFIG_CHECK_INTERVAL = float(os.environ.get('CONFIG_CHECK_INTERVAL', 5))
+
+# shared session for basic auth requests, reusing pooled connections
+# NOTE: connection pools are per host, so the session is shared by all tenants
+AUTH_SESSION = requests.Session()
+auth_adapter = HTTPAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(total=1, backoff_factor=0.1)
+)
+AUTH_SESSION.mount('http://', auth_adapter)
+AUTH_SESSION.mount('https://', auth_adapter)
+# connect and read timeouts in seconds for basic auth requests
+AUTH_TIMEOUT = (
+    float(os.environ.get('AUTH_CONNECT_TIMEOUT', 1.0)),
+    float(os.environ.get('AUTH_READ_TIMEOUT', 3.0))
+)
+
+# thread pool for sending basic auth requests to multiple login URLs
+AUTH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=16, thread_name_prefix='legend-auth'
+)
+
+# cache for successful basic auth identities as
+#     {(<tenant>, <username>, <SHA-256 of password>): <identity>}
+# NOTE: failed logins are not cached
+AUTH_CACHE = TTLCache(
+    maxsize=4096, ttl=float(os.environ.get('AUTH_CACHE_TTL', 30))
+)
+
+
+@app.after_request
+def add_cache_headers(response):
+    """Add cache-disabling headers to all responses, except for legend
+    images with an ETag, which clients may cache and revalidate.
+
+    :param Response response: Response
+    """
+    if response.get_etag()[0] is None:
+        response.headers["Cache-Control"] = \
+            "no-cache, no-store, must-revalidate, max-age=0"
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+    return response
+
 
 def legend_service_handler():
     """Get or create a LegendService instance for a tenant."""
     tenant = tenant_handler.tenant()
-    handler = tenant_handler.handler('legend', 'legend', tenant)
-    if handler is None:
-        handler = tenant_handler.register_handler(
-            'legend', tenant, LegendService(tenant, app.logger))
+    entry = HANDLERS.get(tenant)
+    if entry is not None and time.monotonic() < entry[0]:
+        return entry[1]
+
+    with HANDLERS_LOCK:
+        # NOTE: handler may have been updated by another thread
+        entry = HANDLERS.get(tenant)
+        if entry is not None and time.monotonic() < entry[0]:
+            return entry[1]
+
+        handler = tenant_handler.handler('legend', 'legend', tenant)
+        if handler is None:
+            handler = tenant_handler.register_handler(
+                'legend', tenant, LegendService(tenant, app.logger))
+        HANDLERS[tenant] = (time.monotonic() + CONFIG_CHECK_INTERVAL, handler)
     return handler
 
 
@@ -46,153 +120,155 @@ def get_identity_or_auth(legend_service):
         # Check for basic auth
         auth = request.authorization
         if auth:
+            tenant = tenant_handler.tenant()
+            # NOTE: never store plain passwords
+            cache_key = (
+                tenant, auth.username,
+                hashlib.sha256((auth.password or '').encode()).digest()
+            )
+            identity = AUTH_CACHE.get(cache_key)
+            if identity is not None:
+                return identity
+
             headers = {}
             if tenant_handler.tenant_header:
                 # forward tenant header
-                headers[tenant_handler.tenant_header] = tenant_handler.tenant()
-            for login_url in legend_service.basic_auth_login_url:
-                app.logger.debug(f"Checking basic auth via {login_url}")
-                data = {'username': auth.username, 'password': auth.password}
-                resp = requests.post(login_url, data=data, headers=headers)
-                if resp.ok:
-                    json_resp = json.loads(resp.text)
-                    app.logger.debug(json_resp)
-                    return json_resp.get('identity')
+                headers[tenant_handler.tenant_header] = tenant
+            data = {'username': auth.username, 'password': auth.password}
+
+            def verify_login(login_url):
+                app.logger.debug("Checking basic auth via %s", login_url)
+                try:
+                    return AUTH_SESSION.post(
+                        login_url, data=data, headers=headers,
+                        timeout=AUTH_TIMEOUT
+                    )
+                except (requests.Timeout, requests.ConnectionError) as e:
+                    app.logger.warning(
+                        "Could not check basic auth via %s: %s", login_url, e
+                    )
+                    return None
+
+            login_urls = legend_service.basic_auth_login_url
+            if len(login_urls) > 1:
+                # check all login URLs concurrently and use the first
+                # successful response
+                futures = [
+                    AUTH_EXECUTOR.submit(verify_login, login_url)
+                    for login_url in login_urls
+                ]
+                responses = (
+                    future.result() for future in as_completed(futures)
+                )
+            else:
+                futures = []
+                responses = map(verify_login, login_urls)
+            try:
+                for resp in responses:
+                    if resp is not None and resp.ok:
+                        json_resp = resp.json()
+                        app.logger.debug("Basic auth response: %s", json_resp)
+                        identity = json_resp.get('identity')
+                        if identity:
+                            AUTH_CACHE.set(cache_key, identity)
+                        return identity
+            finally:
+                # skip pending requests for remaining login URLs
+                for future in futures:
+                    future.cancel()
             # Return WWW-Authenticate header, e.g. for browser password prompt
             # raise Unauthorized(
             #     www_authenticate='Basic realm="Login Required"')
     return identity
 
 
-# request parser
-legend_parser = reqparse.RequestParser(argument_class=CaseInsensitiveArgument)
-legend_parser.add_argument('layer', required=True)
-legend_parser.add_argument('styles')
-legend_parser.add_argument('format')
-legend_parser.add_argument('bbox')
-legend_parser.add_argument('crs')
-legend_parser.add_argument('scale')
-legend_parser.add_argument('width')
-legend_parser.add_argument('height')
-legend_parser.add_argument('dpi')
-legend_parser.add_argument('boxspace')
-legend_parser.add_argument('layerspace')
-legend_parser.add_argument('layertitlespace')
-legend_parser.add_argument('symbolspace')
-legend_parser.add_argument('iconlabelspace')
-legend_parser.add_argument('symbolwidth')
-legend_parser.add_argument('symbolheight')
-legend_parser.add_argument('layerfontfamily')
-legend_parser.add_argument('itemfontfamily')
-legend_parser.add_argument('layerfontbold')
-legend_parser.add_argument('itemfontbold')
-legend_parser.add_argument('layerfontsize')
-legend_parser.add_argument('itemfontsize')
-legend_parser.add_argument('layerfontitalic')
-legend_parser.add_argument('itemfontitalic')
-legend_parser.add_argument('layerfontcolor')
-legend_parser.add_argument('itemfontcolor')
-legend_parser.add_argument('layertitle')
-legend_parser.add_argument('rulelabel')
-legend_parser.add_argument('transparent')
-legend_parser.add_argument('type')
-
+# GetLegendGraphic params forwarded to QGIS Server
+# as {<param>: <API doc description>}
+LEGEND_PARAMS = {
+    'bbox': 'The extent to consider for generating the legend',
+    'crs': 'The CRS of the specified extent',
+    'scale': 'The scale to consider for generating the legend',
+    'width': 'The map width',
+    'height': 'The map height',
+    'dpi': 'DPI',
+    'boxspace': 'Space between legend frame and content (mm)',
+    'layerspace': 'Vertical space between layers (mm)',
+    'layertitlespace': 'Vertical space between layer title and items following (mm)',
+    'symbolspace': 'Vertical space between symbol and item following (mm)',
+    'iconlabelspace': 'Horizontal space between symbol and label text (mm)',
+    'symbolwidth': 'Width of the symbol preview (mm)',
+    'symbolheight': 'Height of the symbol preview (mm)',
+    'layerfontfamily': 'Font family for layer title text',
+    'itemfontfamily': 'Font family for layer item text',
+    'layerfontbold': 'Font weight for layer title text',
+    'itemfontbold': 'Font weight for layer item text',
+    'layerfontsize': 'Font size in points for layer title text',
+    'itemfontsize': 'Font size in points for layer item text',
+    'layerfontitalic': 'Font style for layer title text',
+    'itemfontitalic': 'Font style for layer item text',
+    'layerfontcolor': 'Font color for layer title text',
+    'itemfontcolor': 'Font color for layer item text',
+    'layertitle': 'Whether to display layer title text',
+    'transparent': 'Whether to set background transparency',
+    'rulelabel': 'Whether to display layer item text'
+}
 
 # routes
 @api.route('/<path:service_name>')
 @api.param('service_name', 'Service name corresponding to WMS, e.g. `qwc_demo`')
 class Legend(Resource):
     @api.doc('legend')
-    @api.param('layer', 'The layer name')
+    @api.param('layer', 'The layer name', required=True)
     @api.param('styles', 'The layer style')
     @api.param('format', 'The image format', default='image/png')
-    @api.param('bbox', 'The extent to consider for generating the legend')
-    @api.param('crs', 'The CRS of the specified extent')
-    @api.param('scale', 'The scale to consider for generating the legend')
-    @api.param('width', 'The map width')
-    @api.param('height', 'The map height')
-    @api.param('dpi', 'DPI')
-    @api.param('boxspace', 'Space between legend frame and content (mm)')
-    @api.param('layerspace', 'Vertical space between layers (mm)')
-    @api.param('layertitlespace', 'Vertical space between layer title and items following (mm)')
-    @api.param('symbolspace', 'Vertical space between symbol and item following (mm)')
-    @api.param('iconlabelspace', 'Horizontal space between symbol and label text (mm)')
-    @api.param('symbolwidth', 'Width of the symbol preview (mm)')
-    @api.param('symbolheight', 'Height of the symbol preview (mm)')
-    @api.param('layerfontfamily', 'Font family for layer title text')
-    @api.param('itemfontfamily', 'Font family for layer item text')
-    @api.param('layerfontbold', 'Font weight for layer title text')
-    @api.param('itemfontbold', 'Font weight for layer item text')
-    @api.param('layerfontsize', 'Font size in points for layer title text')
-    @api.param('itemfontsize', 'Font size in points for layer item text')
-    @api.param('layerfontitalic', 'Font style for layer title text')
-    @api.param('itemfontitalic', 'Font style for layer item text')
-    @api.param('layerfontcolor', 'Font color for layer title text')
-    @api.param('itemfontcolor', 'Font color for layer item text')
-    @api.param('layertitle', 'Whether to display layer title text')
-    @api.param('rulelabel', 'Whether to display layer item text')
-    @api.param('transparent', 'Whether to set background transparency')
+    @api.doc(params=LEGEND_PARAMS)
     @api.param('type', 'The legend image type, either "thumbnail", or "default". Defaults to "default".')
-    @api.expect(legend_parser)
     @optional_auth
     def get(self, service_name):
         """Get legend graphic
 
         Return legend graphic for specified layer
         """
-        args = legend_parser.parse_args()
-        layer_param = args['layer'] or ''
-        styles_param = args['styles'] or ''
-        format_param = args['format'] or 'image/png'
-        type = (args['type'] or 'default').lower()
+        # NOTE: param names are case insensitive
+        args = {key.lower(): value for key, value in request.args.items()}
+        if 'layer' not in args:
+            api.abort(
+                400, 'Input payload validation failed',
+                errors={'layer': 'Missing required parameter in the query string'}
+            )
+        layer_param = args['layer']
+        styles_param = args.get('styles') or ''
+        format_param = args.get('format') or 'image/png'
+        type = (args.get('type') or 'default').lower()
+        # collect non-empty params to forward to QGIS Server
+        # NOTE: query args are strings, so only empty values are dropped,
+        #       while values like '0' or 'false' are forwarded
         params = {
-            "bbox": args['bbox'] or '',
-            "crs": args['crs'] or '',
-            "scale": args['scale'] or '',
-            "width": args['width'] or '',
-            "height": args['height'] or '',
-            "dpi": args['dpi'] or '',
-            "boxspace": args['boxspace'] or '',
-            "layerspace": args['layerspace'] or '',
-            "layertitlespace": args['layertitlespace'] or '',
-            "symbolspace": args['symbolspace'] or '',
-            "iconlabelspace": args['iconlabelspace'] or '',
-            "symbolwidth": args['symbolwidth'] or '',
-            "symbolheight": args['symbolheight'] or '',
-            "layerfontfamily": args['layerfontfamily'] or '',
-            "itemfontfamily": args['itemfontfamily'] or '',
-            "layerfontbold": args['layerfontbold'] or '',
-            "itemfontbold": args['itemfontbold'] or '',
-            "layerfontsize": args['layerfontsize'] or '',
-            "itemfontsize": args['itemfontsize'] or '',
-            "layerfontitalic": args['layerfontitalic'] or '',
-            "itemfontitalic": args['itemfontitalic'] or '',
-            "layerfontcolor": args['layerfontcolor'] or '',
-            "itemfontcolor": args['itemfontcolor'] or '',
-            "layertitle": args['layertitle'] or '',
-            "transparent": args['transparent'] or '',
-            "rulelabel": args['rulelabel'] or ''
+            key: value for key in LEGEND_PARAMS if (value := args.get(key))
         }
-        # Filter empty params
-        params = {k: v for k, v in params.items() if v}
 
         legend_service = legend_service_handler()
         return legend_service.get_legend(
             service_name, layer_param, styles_param, format_param, params, type,
-            get_identity_or_auth(legend_service)
+            get_identity_or_auth(legend_service),
+            'image/webp' in request.headers.get('Accept', '')
         )
 
 
+# pre-encoded JSON body for probe responses
+PROBE_OK = b'{"status":"OK"}\n'
+
+
 """ readyness probe endpoint """
 @app.route("/ready", methods=['GET'])
 def ready():
-    return jsonify({"status": "OK"})
+    return Response(PROBE_OK, mimetype='application/json')
 
 
 """ liveness probe endpoint """
 @app.route("/healthz", methods=['GET'])
 def healthz():
-    return jsonify({"status": "OK"})
+    return Response(PROBE_OK, mimetype='application/json')
 
 
 # local webserver
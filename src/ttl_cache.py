@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class TTLCache:
+    """TTLCache class
+
+    Thread-safe size bounded cache for values which expire after some time.
+    Least recently used entries are evicted if the max size is exceeded.
+
+    NOTE: expired entries are kept until evicted, so they may still be
+          returned as stale values
+    """
+
+    def __init__(self, maxsize=512, ttl=300):
+        """Constructor
+
+        :param int maxsize: Max number of cache entries
+        :param float ttl: Time in seconds until expiry (0 to disable cache,
+                          None for no expiry)
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # lookup for cache entries as {<key>: (<expires or None>, <value>)}
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        """Return cached value or default if not present or expired.
+
+        :param obj key: Hashable key for value
+        :param obj default: Default value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (
+                entry[0] is not None and time.monotonic() >= entry[0]
+            ):
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def get_stale(self, key, default=None):
+        """Return cached value, even if expired, or default if not present.
+
+        :param obj key: Hashable key for value
+        :param obj default: Default value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        """Store value under key until expiry.
+
+        :param obj key: Hashable key for value
+        :param obj value: Value to store
+        """
+        if self.maxsize <= 0 or (self.ttl is not None and self.ttl <= 0):
+            # cache disabled
+            return
+
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                # remove least recently used entry
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all cache entries."""
+        with self.lock:
+            self.entries.clear()
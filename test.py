@@ -1,6 +1,8 @@
 import unittest
 
 from tests.api_tests import *
+from tests.legend_service_tests import *
+from tests.auth_tests import *
 
 
 if __name__ == '__main__':
@@ -15,9 +15,10 @@ JWTManager(server.app)
 class ApiTestCase(unittest.TestCase):
     """Test case for server API"""
 
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         server.app.testing = True
-        self.app = FlaskClient(server.app, Response)
+        cls.app = FlaskClient(server.app, Response)
 
     def tearDown(self):
         pass
@@ -0,0 +1,116 @@
+import time
+from types import SimpleNamespace
+import unittest
+from unittest.mock import Mock, patch
+
+from werkzeug.datastructures import Authorization
+
+import server
+from ttl_cache import TTLCache
+
+
+class AuthTestCase(unittest.TestCase):
+    """Test case for basic auth"""
+
+    def setUp(self):
+        server.AUTH_CACHE.clear()
+        self.legend_service = SimpleNamespace(
+            basic_auth_login_url=['http://localhost:9090/verify_login']
+        )
+
+    def tearDown(self):
+        server.AUTH_CACHE.clear()
+
+    def verify_login(self, login_url, data, headers, timeout):
+        """Return stub auth service response."""
+        if data['password'] == 'secret':
+            return Mock(ok=True, json=Mock(return_value={
+                'identity': {'username': data['username']}
+            }))
+        return Mock(ok=False)
+
+    def get_identity(self, username, password):
+        auth = Authorization('basic', {
+            'username': username, 'password': password
+        })
+        with server.app.test_request_context(
+            headers={'Authorization': auth.to_header()}
+        ), patch('server.get_identity', return_value=None):
+            return server.get_identity_or_auth(self.legend_service)
+
+    def test_cache_hit(self):
+        with patch.object(
+            server.AUTH_SESSION, 'post', side_effect=self.verify_login
+        ) as post:
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            self.assertEqual(1, post.call_count)
+
+    def test_cache_miss_for_other_password(self):
+        with patch.object(
+            server.AUTH_SESSION, 'post', side_effect=self.verify_login
+        ) as post:
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            self.assertIsNone(self.get_identity('demo', 'wrong'))
+            self.assertEqual(2, post.call_count)
+
+    def test_failed_login_not_cached(self):
+        with patch.object(
+            server.AUTH_SESSION, 'post', side_effect=self.verify_login
+        ) as post:
+            self.assertIsNone(self.get_identity('demo', 'wrong'))
+            self.assertIsNone(self.get_identity('demo', 'wrong'))
+            self.assertEqual(2, post.call_count)
+
+    def test_cache_disabled(self):
+        # NOTE: cache as created for AUTH_CACHE_TTL=0
+        with patch.object(
+            server, 'AUTH_CACHE', TTLCache(maxsize=4096, ttl=0)
+        ), patch.object(
+            server.AUTH_SESSION, 'post', side_effect=self.verify_login
+        ) as post:
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            self.assertEqual(2, post.call_count)
+
+    def test_first_successful_login_url(self):
+        # NOTE: login URLs are checked concurrently, and the identity from
+        #       the first successful response is used
+        self.legend_service.basic_auth_login_url = [
+            'http://slow/verify_login', 'http://fast/verify_login'
+        ]
+
+        def verify_login(login_url, data, headers, timeout):
+            if login_url.startswith('http://slow/'):
+                time.sleep(0.2)
+                return Mock(ok=True, json=Mock(return_value={
+                    'identity': {'username': 'slow'}
+                }))
+            return self.verify_login(login_url, data, headers, timeout)
+
+        with patch.object(
+            server.AUTH_SESSION, 'post', side_effect=verify_login
+        ) as post:
+            # fast successful response wins
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            # slow successful response after failed fast response
+            self.assertEqual(
+                {'username': 'slow'}, self.get_identity('demo', 'wrong')
+            )
+            # first identity is cached
+            self.assertEqual(
+                {'username': 'demo'}, self.get_identity('demo', 'secret')
+            )
+            self.assertEqual(4, post.call_count)
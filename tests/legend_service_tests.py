@@ -0,0 +1,356 @@
+import hashlib
+from io import BytesIO
+import logging
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock, patch
+from PIL import Image, ImageChops
+
+from flask import Flask
+import requests
+from legend_service import LegendService, RESOURCES_CACHE, pyvips
+
+# Flask app for request contexts of legend responses
+app = Flask(__name__)
+
+
+# config path with test tenant config and permissions
+TEST_CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config')
+TEST_TENANT = 'legend_test'
+
+# custom legend image of layers A1 and A21 in test config
+LEGEND_IMAGE_BASE64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAgAAAAICAIAAABLbSncAAAAHUlEQVQI12NgwAEYGRgY/tdj"
+    "iDYyMOHSQQ8JnAAAUUoCDCaibn8AAAAASUVORK5CYII="
+)
+
+
+class LegendServiceTestCase(unittest.TestCase):
+    """Test case for LegendService"""
+
+    @classmethod
+    def setUpClass(cls):
+        # base dir for extracted Base64 encoded legend images
+        cls.base64_images_dir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.base64_images_dir.cleanup()
+
+    def setUp(self):
+        self.legend_service = self.new_legend_service(
+            self.base64_images_dir.name
+        )
+        # stub QGIS server requests
+        self.qgis_status_code = 200
+        self.qgis_error = None
+        self.legend_service.session.get = Mock(side_effect=self.qgis_get)
+
+    def tearDown(self):
+        self.legend_service.executor.shutdown()
+
+    def new_legend_service(self, base64_images_path):
+        with patch.dict(os.environ, {
+            'CONFIG_PATH': TEST_CONFIG_PATH,
+            'BASE64_IMAGES_PATH': base64_images_path
+        }):
+            legend_service = LegendService(
+                TEST_TENANT, logging.getLogger(__name__)
+            )
+        self.addCleanup(legend_service.executor.shutdown)
+        return legend_service
+
+    def qgis_get(self, url, params, timeout):
+        """Return stub QGIS server response with a legend image whose
+        height depends on the layer name."""
+        if self.qgis_error is not None:
+            raise self.qgis_error
+        output = BytesIO()
+        Image.new(
+            "RGB", (20, 5 + len(params['layer'])), (0, 0, 255)
+        ).save(output, "PNG")
+        return Mock(
+            status_code=self.qgis_status_code, content=output.getvalue(),
+            url=url
+        )
+
+    def get_legend(self, layer_param, identity=None, headers={},
+                   webp_accepted=False):
+        with app.test_request_context(headers=headers):
+            return self.legend_service.get_legend(
+                'test_wms', layer_param, '', 'image/png', {}, 'default',
+                identity, webp_accepted
+            )
+
+    def image_size(self, response):
+        return Image.open(BytesIO(response.get_data())).size
+
+    def expanded_layers(self, layer_param, identity=None):
+        permitted_resources = self.legend_service.permitted_resources(
+            'test_wms', identity
+        )
+        expanded_layer_styles = self.legend_service.expanded_layer_styles(
+            'test_wms', layer_param, '', permitted_resources
+        )
+        return [entry['layer'] for entry in expanded_layer_styles]
+
+    def test_expand_nested_groups(self):
+        # NOTE: A1 and A21 have custom legend images
+        self.assertEqual(['A1', 'A21', 'A22'], self.expanded_layers('A'))
+        self.assertEqual(['A21', 'A22'], self.expanded_layers('A2'))
+        self.assertEqual(['A1', 'A21', 'A22'], self.expanded_layers('A', 'alice'))
+
+    def test_expand_restricted_groups(self):
+        # NOTE: B, C2 and E are not permitted for public role
+        self.assertEqual(['C1'], self.expanded_layers('C'))
+        self.assertEqual(['A1', 'A21', 'A22', 'C1'], self.expanded_layers('test'))
+        self.assertEqual([], self.expanded_layers('B'))
+        self.assertEqual(['C1', 'C1'], self.expanded_layers('C,B,E,C1'))
+
+    def test_expand_all_permitted(self):
+        # NOTE: complete groups without custom legend images are not expanded
+        self.assertEqual(['C'], self.expanded_layers('C', 'alice'))
+        self.assertEqual(
+            ['A1', 'A21', 'A22', 'B', 'C', 'E'],
+            self.expanded_layers('test', 'alice')
+        )
+        self.assertEqual(
+            ['B', 'C2', 'A21', 'A22'], self.expanded_layers('B,C2,A2', 'alice')
+        )
+
+    def test_restricted_identity_does_not_affect_others(self):
+        # NOTE: restricted sublayers must not leak into shared resources
+        self.assertEqual(['A1', 'A21', 'A22', 'C1'], self.expanded_layers('test'))
+        expected = ['A1', 'A21', 'A22', 'B', 'C', 'E']
+        self.assertEqual(expected, self.expanded_layers('test', 'alice'))
+
+        # check new service instance reusing loaded resources
+        self.tearDown()
+        self.setUp()
+        self.assertEqual(expected, self.expanded_layers('test', 'alice'))
+
+    def test_legend_cache_per_permitted_layers(self):
+        response = self.get_legend('test')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual((20, 31), self.image_size(response))
+
+        # NOTE: B, C and E are additionally permitted
+        alice_response = self.get_legend('test', 'alice')
+        self.assertEqual(200, alice_response.status_code)
+        self.assertEqual((20, 42), self.image_size(alice_response))
+        self.assertNotEqual(response.get_data(), alice_response.get_data())
+
+        # check cached legends
+        requests_count = self.legend_service.session.get.call_count
+        self.assertEqual(
+            response.get_data(), self.get_legend('test').get_data()
+        )
+        self.assertEqual(
+            alice_response.get_data(),
+            self.get_legend('test', 'alice').get_data()
+        )
+        self.assertEqual(
+            requests_count, self.legend_service.session.get.call_count
+        )
+
+    def test_fallback_legend_not_cached(self):
+        # empty image after server error
+        self.qgis_status_code = 500
+        response = self.get_legend('B', 'alice')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual((1, 1), self.image_size(response))
+
+        self.qgis_status_code = 200
+        response = self.get_legend('B', 'alice')
+        self.assertEqual((20, 6), self.image_size(response))
+        self.assertEqual(2, self.legend_service.session.get.call_count)
+
+        # stale cached image after server error, once cached legends expired
+        expired = time.monotonic() + 3600
+        with patch('ttl_cache.time.monotonic', return_value=expired):
+            self.qgis_status_code = 500
+            response = self.get_legend('B', 'alice')
+            self.assertEqual((20, 6), self.image_size(response))
+            self.assertEqual(3, self.legend_service.session.get.call_count)
+
+            self.qgis_status_code = 200
+            self.get_legend('B', 'alice')
+            self.assertEqual(4, self.legend_service.session.get.call_count)
+
+    def test_fallback_legend_after_request_error(self):
+        # empty image if QGIS server is not reachable
+        self.qgis_error = requests.ConnectionError("Connection refused")
+        response = self.get_legend('B', 'alice')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual((1, 1), self.image_size(response))
+
+        self.qgis_error = None
+        self.get_legend('B', 'alice')
+
+        # stale cached image after timeout, once cached legends expired
+        expired = time.monotonic() + 3600
+        with patch('ttl_cache.time.monotonic', return_value=expired):
+            self.qgis_error = requests.ReadTimeout("Read timed out")
+            response = self.get_legend('B', 'alice')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual((20, 6), self.image_size(response))
+
+            # fallback legend is not cached
+            self.qgis_error = None
+            self.get_legend('B', 'alice')
+            self.assertEqual(4, self.legend_service.session.get.call_count)
+
+    def test_conditional_request(self):
+        response = self.get_legend('test')
+        etag = response.get_etag()[0]
+        self.assertIsNotNone(etag)
+
+        response = self.get_legend('test', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+
+        response = self.get_legend(
+            'test', 'alice', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(200, response.status_code)
+
+    def test_conditional_request_custom_image(self):
+        # NOTE: single custom legend image is sent from file
+        response = self.get_legend('A1')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/png', response.mimetype)
+        response.direct_passthrough = False
+        self.assertEqual((8, 8), self.image_size(response))
+        etag = response.get_etag()[0]
+        self.assertIsNotNone(etag)
+        response.close()
+
+        response = self.get_legend('A1', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(0, self.legend_service.session.get.call_count)
+        response.close()
+
+    def test_extract_base64_legend_images(self):
+        with tempfile.TemporaryDirectory() as base64_images_path:
+            legend_service = self.new_legend_service(base64_images_path)
+            legend_images = legend_service.resources['wms_services'][
+                'test_wms']['legend_images']
+
+            # NOTE: A1 and A21 have the same custom legend image
+            base64_dir = os.path.join(base64_images_path, TEST_TENANT)
+            image_path = os.path.join(base64_dir, "%s.png" % hashlib.blake2b(
+                LEGEND_IMAGE_BASE64.encode(), digest_size=16
+            ).hexdigest())
+            self.assertEqual(image_path, legend_images['A1'])
+            self.assertEqual(image_path, legend_images['A21'])
+            self.assertEqual(
+                [os.path.basename(image_path)], os.listdir(base64_dir)
+            )
+            with Image.open(image_path) as img:
+                self.assertEqual((8, 8), img.size)
+
+            # existing image file is reused on reload
+            st = os.stat(image_path)
+            RESOURCES_CACHE.clear()
+            legend_service = self.new_legend_service(base64_images_path)
+            self.assertEqual(
+                image_path, legend_service.resources['wms_services'][
+                    'test_wms']['legend_images']['A1']
+            )
+            self.assertEqual(st.st_ino, os.stat(image_path).st_ino)
+            self.assertEqual(st.st_mtime_ns, os.stat(image_path).st_mtime_ns)
+
+            # stale image files are removed on reload
+            stale_path = os.path.join(base64_dir, "%s.png" % ('0' * 32))
+            other_path = os.path.join(base64_dir, "other.txt")
+            for path in (stale_path, other_path):
+                with open(path, 'wb'):
+                    pass
+            RESOURCES_CACHE.clear()
+            self.new_legend_service(base64_images_path)
+            self.assertEqual(
+                sorted([os.path.basename(image_path), "other.txt"]),
+                sorted(os.listdir(base64_dir))
+            )
+
+    def test_private_dir_invalid_name(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            base_path = os.path.join(base_dir, 'base')
+            for name in ('', '.', '..', '../other', 'sub/dir', '/other'):
+                with self.assertRaises(OSError):
+                    self.legend_service.private_dir(base_path, name)
+            self.assertEqual([], os.listdir(base_dir))
+
+    def test_webp_negotiation(self):
+        self.legend_service.webp_negotiation = True
+        response = self.get_legend('test', webp_accepted=True)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/webp', response.mimetype)
+        self.assertEqual(
+            'WEBP', Image.open(BytesIO(response.get_data())).format
+        )
+        self.assertIn('Accept', response.vary)
+
+        # PNG if WebP is not accepted by client
+        response = self.get_legend('test')
+        self.assertEqual('image/png', response.mimetype)
+        self.assertIn('Accept', response.vary)
+
+        self.legend_service.webp_negotiation = False
+        response = self.get_legend('test', webp_accepted=True)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/png', response.mimetype)
+        self.assertEqual(
+            'PNG', Image.open(BytesIO(response.get_data())).format
+        )
+        self.assertNotIn('Accept', response.vary)
+
+    def legend_images(self):
+        """Return image entries for composing legend images with various
+        image modes and transparency."""
+        images = [
+            Image.new("RGBA", (20, 5), (255, 0, 0, 128)),
+            Image.new("LA", (10, 4), (0, 0)),
+            Image.new("P", (15, 3), 0),
+            Image.new("RGB", (20, 3), (0, 255, 0)),
+            Image.new("L", (12, 2), 128)
+        ]
+        images[2].putpalette([0, 0, 0, 0, 0, 255])
+        images[2].paste(1, (0, 0, 5, 3))
+        imgdata = []
+        for img in images:
+            output = BytesIO()
+            if img.mode == "P":
+                img.save(output, "PNG", transparency=0)
+            else:
+                img.save(output, "PNG")
+            data = output.getvalue()
+            imgdata.append({
+                "data": data, "format": "image/png",
+                "image": Image.open(BytesIO(data)), "size": img.size
+            })
+        return imgdata
+
+    @unittest.skipIf(pyvips is None, "pyvips not installed")
+    def test_compose_images_pil_and_vips(self):
+        for has_alpha in (False, True):
+            mode = "RGBA" if has_alpha else "RGB"
+            pil_image = self.legend_service.compose_images_pil(
+                self.legend_images(), 20, 17, mode
+            )
+            vips_image = Image.open(BytesIO(
+                self.legend_service.compose_images_vips(
+                    self.legend_images(), 20, has_alpha, "image/png"
+                )
+            ))
+            self.assertEqual(mode, vips_image.mode)
+            self.assertEqual(pil_image.size, vips_image.size)
+            # NOTE: allow rounding differences when blending
+            extrema = ImageChops.difference(pil_image, vips_image).getextrema()
+            self.assertLessEqual(max(high for low, high in extrema), 1)
+
+            if not has_alpha:
+                # transparent pixels are blended onto white
+                self.assertEqual((255, 255, 255), pil_image.getpixel((0, 5)))
+                self.assertEqual((255, 255, 255), pil_image.getpixel((10, 9)))